@@ -23,6 +23,16 @@ from cudaq.qis import *
 import numpy as np
 from mpi4py import MPI
 from typing import List
+import functools
+import logging
+import operator
+
+# numba is optional: when it is installed, the classical cut value and penalty
+# loops are compiled, otherwise we fall back to the NumPy implementations below
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 
 # Getting information about platform
@@ -34,6 +44,31 @@ comm = MPI.COMM_WORLD
 rank = comm.Get_rank()
 num_qpus = comm.Get_size()
 
+# Set DEBUG to True to log the subgraph keys assigned to each processor and the full
+# results dictionary gathered on GPU 0. These are left out by default since the output of all
+# of the processes goes to the same stream.
+DEBUG = False
+
+# The output of all of the processes is funneled through the same stream by the MPI launcher,
+# and each message is tagged with the rank of the process that sent it.
+# The messages about assigning and gathering the subgraph problems are only logged by GPU 0
+# (by every process with DEBUG set). The progress of the algorithm itself, including the optimal 
+# QAOA parameters found for each subgraph, is logged by every process.
+# We configure loggers of our own rather than the root logger so that DEBUG does not
+# also turn on the debug output of the libraries we use (numba in particular).
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter('[rank {}] %(message)s'.format(rank)))
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG if DEBUG else (logging.INFO if rank == 0 else logging.WARNING))
+logger.addHandler(log_handler)
+logger.propagate = False
+
+progress_logger = logging.getLogger(__name__ + '.progress')
+progress_logger.setLevel(logging.INFO)
+progress_logger.addHandler(log_handler)
+progress_logger.propagate = False
+
 # Define a function to generate the Hamiltonian for a max cut problem using the graph G
 def hamiltonian_max_cut(sources : List[int], targets : List[int], weights : List[float]): 
     """Hamiltonian for finding the max cut for the graph  with edges defined by the pairs generated by source and target edges
@@ -51,15 +86,11 @@ def hamiltonian_max_cut(sources : List[int], targets : List[int], weights : List
     cudaq.SpinOperator
         Hamiltonian for finding the max cut of the graph defined by the given edges
     """
-    hamiltonian = 0
-    # Since our vertices may not be a list from 0 to n, or may not even be integers,
-    
-    for i in range(len(sources)):
-        # Add a term to the Hamiltonian for the edge (u,v)
-        qubitu = sources[i]
-        qubitv = targets[i]
-        edge_weight = weights[i]
-        hamiltonian += 0.5*edge_weight*(spin.z(qubitu)*spin.z(qubitv)-spin.i(qubitu)*spin.i(qubitv))
+    # Each edge (u,v) contributes 0.5*w*(Z_u Z_v - I), so we build the Z_u Z_v terms once,
+    # sum them in a single reduction, and combine all of the identity terms into one
+    w = np.asarray(weights, dtype=np.float64)
+    zz_terms = [spin.z(int(s))*spin.z(int(t)) for s, t in zip(sources, targets)]
+    hamiltonian = 0.5*(functools.reduce(operator.add, (wi*zz for wi, zz in zip(w.tolist(), zz_terms))) - float(w.sum())*spin.i(0))
     
     return hamiltonian
 
@@ -138,6 +169,63 @@ def kernel_qaoa(qubit_count :int, layer_count: int, edges_src: List[int], edges_
         for j in range(qubit_count):
             qaoaMixer(qreg[j],thetas[i+layer_count])
 
+# The graph structure (qubit_count, layer_count, edges_src, edges_tgt) enters kernel_qaoa as runtime
+# arguments rather than being baked into the circuit, so a single compiled kernel serves every
+# subgraph and merger graph. Compile the kernels once up front so that this cost is not paid
+# inside the first optimizer call and every VQE iteration reuses the same compiled kernel.
+qaoaProblem.compile()
+qaoaMixer.compile()
+kernel_qaoa.compile()
+
+# The sorted list of nodes and the list of edges of a graph are needed by almost every function
+# below. Rather than recomputing them on every call, we record them once as graph attributes
+# when the (sub)graphs are built and read them from there.
+def cache_node_and_edge_lists(G):
+    """Record the sorted nodes and the edges of G in G.graph['sorted_nodes'] and G.graph['edge_list'],
+    along with the NumPy edge arrays in G.graph['edge_arrays']
+    
+    Parameters
+    ----------
+    G: networkX.Graph 
+        Graph whose structure and edge weights will not change after this function is called
+
+    Returns
+    -------
+    networkX.Graph
+        G with the sorted_nodes, edge_list and edge_arrays graph attributes
+    """
+    # Copies of subgraphs inherit the parent's graph attributes, including the parent's cached
+    # lists and arrays. Replace the lists and drop the arrays, which index the parent's nodes,
+    # before building the arrays for G
+    G.graph = dict(G.graph, sorted_nodes=sorted(G.nodes()), edge_list=list(G.edges()))
+    G.graph.pop('edge_arrays', None)
+    G.graph['edge_arrays'] = edge_arrays(G)
+    return G
+
+def sorted_nodes(G):
+    """Returns the sorted list of nodes of G, using the cached list if there is one"""
+    if 'sorted_nodes' in G.graph:
+        return G.graph['sorted_nodes']
+    return sorted(G.nodes())
+
+def edge_list(G):
+    """Returns the list of edges of G, using the cached list if there is one"""
+    if 'edge_list' in G.graph:
+        return G.graph['edge_list']
+    return list(G.edges())
+
+def edge_arrays(G):
+    """Returns the edges of G as an array of shape (number of edges, 2) holding the positions of the endpoints 
+    in sorted_nodes(G), together with the array of edge weights, using the cached arrays if there are any.
+    Edges without a weight are given weight 1."""
+    if 'edge_arrays' in G.graph:
+        return G.graph['edge_arrays']
+    node_index = {v: i for i, v in enumerate(sorted_nodes(G))}
+    edges = edge_list(G)
+    index_array = np.array([(node_index[u], node_index[v]) for u, v in edges], dtype=np.intp).reshape(-1, 2)
+    weights = np.array([G.edges[u, v].get('weight', 1) for u, v in edges])
+    return index_array, weights
+
 def find_optimal_parameters(G, layer_count, seed):
     """Function for finding the optimal parameters of QAOA for the max cut of a graph
     Parameters
@@ -157,14 +245,16 @@ def find_optimal_parameters(G, layer_count, seed):
    
 
     # Problem parameters
-    nodes = sorted(list(nx.nodes(G)))
+    nodes = sorted_nodes(G)
+    # Dictionary that reads out the qubit associated with each vertex
+    idx = {node: i for i, node in enumerate(nodes)}
     qubit_src = []
     qubit_tgt = []
     weights = []
-    for u, v in nx.edges(G):
-        # We can use the index() command to read out the qubits associated with the vertex u and v.
-        qubit_src.append(nodes.index(u))
-        qubit_tgt.append(nodes.index(v))
+    for u, v in edge_list(G):
+        # We can use the idx dictionary to read out the qubits associated with the vertex u and v.
+        qubit_src.append(idx[u])
+        qubit_tgt.append(idx[v])
         weights.append(G.edges[u,v]['weight'])                                           
     # The number of qubits we'll need is the same as the number of vertices in our graph
     qubit_count : int = len(nodes)
@@ -172,17 +262,18 @@ def find_optimal_parameters(G, layer_count, seed):
     parameter_count : int = 2*layer_count
     
     # Specify the initial parameters. 
-    np.random.seed(seed)
-    cudaq.set_random_seed(seed)
-    initial_parameters = np.random.uniform(-np.pi, np.pi,
-                                           parameter_count).tolist()
+    rng = np.random.default_rng(seed)
+    initial_parameters = rng.uniform(-np.pi, np.pi, parameter_count).tolist()
 
-    # Pass the kernel, spin operator, and optimizer to `solvers.vqe`.
+    # Pass the kernel, spin operator, optimizer, and gradient to `solvers.vqe`.
+    # The parameter-shift gradient lets us use the gradient-based L-BFGS optimizer,
+    # which typically needs far fewer iterations than COBYLA.
     optimal_expectation, optimal_parameters, _ = solvers.vqe(
         lambda thetas: kernel_qaoa(qubit_count, layer_count, qubit_src, qubit_tgt, thetas),
         hamiltonian_max_cut(qubit_src, qubit_tgt, weights),
         initial_parameters,
-        optimizer='cobyla')
+        optimizer='lbfgs',
+        gradient='parameter_shift')
 
     return optimal_parameters
 
@@ -214,6 +305,45 @@ def subgraph_of_vertex(graph_dictionary, vertex):
             location = key
     return location
 
+def vertex_to_subgraph(graph_dictionary):
+    """
+    A function that takes as input a subgraph partition (in the form of a graph dictionary) and
+    returns a dictionary mapping each vertex to the key of the subgraph that contains it.
+    This lets us replace repeated calls to subgraph_of_vertex with a single lookup.
+    
+    Parameters
+    ----------
+    graph_dictionary: dict of networkX.Graph with str as keys 
+
+    Returns
+    -------
+    dict
+        dictionary whose keys are vertices and whose values are the keys of the subgraphs containing them
+    """
+    return {v: key for key, SubG in graph_dictionary.items() for v in SubG.nodes()}
+
+def vertex_owner_array(G, graph_dictionary):
+    """
+    Returns an array whose i-th entry is the position in sorted(graph_dictionary) of the subgraph 
+    that contains the i-th vertex of sorted_nodes(G). Vertices that do not appear in the graph_dictionary
+    are each given their own index past the last subgraph.
+    
+    Parameters
+    ----------
+    G: networkX.Graph 
+        Graph whose vertices are partitioned by the graph_dictionary
+    graph_dictionary: dict of networkX.Graph with str as keys 
+
+    Returns
+    -------
+    numpy.ndarray of int
+        subgraph index of each vertex of G
+    """
+    owner = vertex_to_subgraph(graph_dictionary)
+    subgraph_index = {key: i for i, key in enumerate(sorted(graph_dictionary))}
+    return np.array([subgraph_index[owner[v]] if v in owner else len(subgraph_index) + i
+                     for i, v in enumerate(sorted_nodes(G))], dtype=np.intp)
+
 def border(G, subgraph_dictionary):
     """Build a graph made up of border vertices from the subgraph partition
     
@@ -229,19 +359,80 @@ def border(G, subgraph_dictionary):
     networkX.Graph
         Subgraph of G made up of only the edges connecting subgraphs in the subgraph dictionary
     """   
+    # The subgraphs are induced subgraphs of G, so an edge of G is a border edge exactly 
+    # when its endpoints lie in different subgraphs. Read this off of the edge arrays of G in one pass.
+    vertex_owner = vertex_owner_array(G, subgraph_dictionary)
+    edges, _ = edge_arrays(G)
+    crossing = np.flatnonzero(vertex_owner[edges[:, 0]] != vertex_owner[edges[:, 1]])
+    
+    all_edges = edge_list(G)
     borderGraph = nx.Graph()
-    for u,v in G.edges():
-        border = True
-        for key in subgraph_dictionary:
-            SubG = subgraph_dictionary[key]
-            edges = list(nx.edges(SubG))
-            if (u,v) in edges:
-                border = False
-        if border==True:
-            borderGraph.add_edge(u,v)
+    borderGraph.add_edges_from(all_edges[i] for i in crossing.tolist())
         
     return borderGraph
 
+def cut_value_kernel(edges_u, edges_v, weights, colors):
+    """Returns the total weight of the edges (edges_u[i], edges_v[i]) whose endpoints have different colors"""
+    # Start from a zero of the same type as the weights so that integer weights give an integer cut value
+    cut = weights[:0].sum()
+    for i in range(edges_u.shape[0]):
+        if colors[edges_u[i]] != colors[edges_v[i]]:
+            cut += weights[i]
+    return cut
+
+if njit is not None:
+    cut_value_kernel = njit(cache=True)(cut_value_kernel)
+
+class GraphState:
+    """Array (structure-of-arrays) representation of a graph with binary vertex colors.
+    Vertices are indexed by their position in the sorted list of nodes of the graph, so that
+    the colors and edges can be processed with NumPy rather than with NetworkX attribute lookups.
+    
+    Parameters
+    ----------
+    G: networkX.Graph 
+        Graph with (optionally) weighted edges and (optionally) binary value colors assigned to the vertices.
+        Edges without a weight are given weight 1 and vertices without a color are given the color 0.
+
+    Attributes
+    ----------
+    nodes : list
+        sorted list of the nodes of G
+    node_index : dict
+        dictionary whose keys are the nodes of G and whose values are their positions in nodes
+    colors : numpy.ndarray of int8
+        colors[i] is the color of the vertex nodes[i]
+    edges : numpy.ndarray of int
+        array of shape (number of edges, 2) holding the indices of the endpoints of each edge
+    weights : numpy.ndarray
+        weights[i] is the weight of the edge edges[i]
+    """
+    def __init__(self, G):
+        self.nodes = sorted_nodes(G)
+        self.node_index = {v: i for i, v in enumerate(self.nodes)}
+        self.colors = np.fromiter((int(G.nodes[v].get('color', 0)) for v in self.nodes),
+                                  dtype=np.int8, count=len(self.nodes))
+        # For graphs with cached edge arrays only the colors are read from G
+        self.edges, self.weights = edge_arrays(G)
+
+    def cut_value(self):
+        """Returns the cut value determined by the vertex colors and edge weights"""
+        if njit is not None:
+            return cut_value_kernel(self.edges[:, 0], self.edges[:, 1], self.weights, self.colors)
+        cut_edges = self.colors[self.edges[:, 0]] ^ self.colors[self.edges[:, 1]]
+        return (cut_edges * self.weights).sum().item()
+
+    def cut_values(self, colorings):
+        """Returns the cut values for a batch of colorings, given as an array of shape (number of colorings, number of nodes)"""
+        cut_edges = colorings[:, self.edges[:, 0]] ^ colorings[:, self.edges[:, 1]]
+        return cut_edges @ self.weights
+
+    def write_colors(self, G):
+        """Record the colors held in this GraphState as the 'color' attribute of the vertices of G"""
+        for v, c in zip(self.nodes, self.colors.tolist()):
+            G.nodes[v]['color'] = str(c)
+        return G
+
 def cutvalue(G):
     """Returns the cut value of G based on the coloring of the nodes of G
     
@@ -256,10 +447,7 @@ def cutvalue(G):
         cut value of the graph determined by the vertex colors and edge weights
     """  
 
-    cut = 0
-    for u, v in G.edges():
-        if str(G.nodes[u]['color']) != str(G.nodes[v]['color']): 
-            cut+=G.edges[u,v]['weight']
+    cut = GraphState(G).cut_value()
     return cut
 
 def subgraphpartition(G,n, name, globalGraph):
@@ -291,13 +479,15 @@ def subgraphpartition(G,n, name, globalGraph):
         graph_names.append(subgraphname)
 
     for i in range(number_of_subgraphs):
-        nodelist = sorted(list(greedy_partition[i]))
-        graph_dictionary[graph_names[i]] = nx.subgraph(globalGraph, nodelist)
+        nodelist = sorted(greedy_partition[i])
+        # Store a copy of the subgraph rather than a view of globalGraph so that later calls to
+        # nodes() and edges() do not have to filter the adjacency of globalGraph
+        graph_dictionary[graph_names[i]] = cache_node_and_edge_lists(globalGraph.subgraph(nodelist).copy())
      
     return(graph_dictionary) 
 
 
-def qaoa_for_graph(G, layer_count, shots, seed):
+def qaoa_for_graph(G, layer_count, shots, seed, candidate_count=4, candidate_noise=0.1):
     """Function for finding the max cut of a graph using QAOA
     
     Parameters
@@ -307,9 +497,14 @@ def qaoa_for_graph(G, layer_count, shots, seed):
     layer_count : int 
         Number of layers in the QAOA circuit
     shots : int
-        Number of shots in the sampling subroutine
+        Total number of shots in the sampling subroutine, split evenly between the candidate parameter sets
     seed : int
         Random seed for reproducibility of results
+    candidate_count : int
+        Number of parameter sets to sample: the optimal parameters together with
+        candidate_count - 1 random perturbations of them
+    candidate_noise : float
+        Standard deviation of the random perturbations of the optimal parameters
 
     Returns
     -------
@@ -319,23 +514,23 @@ def qaoa_for_graph(G, layer_count, shots, seed):
     if nx.number_of_nodes(G) ==1 or nx.number_of_edges(G) ==0: 
         # The first condition implies the second condition so we really don't need 
         # to consider the case nx.number_of_nodes(G) ==1
-        results = ''
-        for u in list(nx.nodes(G)):
-            np.random.seed(seed)
-            random_assignment = str(np.random.randint(0, 1))
-            results+=random_assignment
+        # Without edges every coloring is a max cut, so assign the colors at random
+        rng = np.random.default_rng(seed)
+        results = ''.join(map(str, rng.integers(0, 2, size=nx.number_of_nodes(G)).tolist()))
         
     else:
         parameter_count: int = 2 * layer_count
 
         # Problem parameters
-        nodes = sorted(list(nx.nodes(G)))
+        nodes = sorted_nodes(G)
+        # Dictionary that reads out the qubit associated with each vertex
+        idx = {node: i for i, node in enumerate(nodes)}
         qubit_src = []
         qubit_tgt = []
-        for u, v in nx.edges(G):
-            # We can use the index() command to read out the qubits associated with the vertex u and v.
-            qubit_src.append(nodes.index(u))
-            qubit_tgt.append(nodes.index(v))
+        for u, v in edge_list(G):
+            # We can use the idx dictionary to read out the qubits associated with the vertex u and v.
+            qubit_src.append(idx[u])
+            qubit_tgt.append(idx[v])
         # The number of qubits we'll need is the same as the number of vertices in our graph
         qubit_count : int = len(nodes)
         # Each layer of the QAOA kernel contains 2 parameters
@@ -344,12 +539,28 @@ def qaoa_for_graph(G, layer_count, shots, seed):
         optimal_parameters = find_optimal_parameters(G, layer_count, seed)
 
         # Print the optimized parameters
-        print("Optimal parameters = ", optimal_parameters)
+        progress_logger.info('Optimal parameters = %s', optimal_parameters)
+        # The VQE above uses exact expectation values, so the sampler only needs seeding once, here.
+        # Seeding from seed alone keeps the result independent of which GPU process solves G.
         cudaq.set_random_seed(seed)
-        # Sample the circuit
-        counts = cudaq.sample(kernel_qaoa, qubit_count, layer_count, qubit_src, qubit_tgt, optimal_parameters, shots_count=shots)
-        print('most_probable outcome = ',counts.most_probable())
-        results = str(counts.most_probable())
+        # Sample the circuit for the optimal parameters and a few perturbations of them.
+        # The sample_async calls are queued back-to-back and we only wait on them afterwards.
+        rng = np.random.default_rng(seed)
+        theta_batch = [list(optimal_parameters)] + [
+            (np.asarray(optimal_parameters) + candidate_noise*rng.standard_normal(len(optimal_parameters))).tolist()
+            for _ in range(candidate_count - 1)]
+        # Split the shot budget between the candidates so the total number of shots stays at shots
+        shots_per_candidate = max(1, shots // candidate_count)
+        handles = [cudaq.sample_async(kernel_qaoa, qubit_count, layer_count, qubit_src, qubit_tgt, thetas, shots_count=shots_per_candidate)
+                   for thetas in theta_batch]
+        counts_list = [handle.get() for handle in handles]
+        
+        # Return the sampled bitstring with the largest cut value
+        bitstrings = sorted({bitstring for counts in counts_list for bitstring in counts})
+        colorings = np.array([list(bitstring) for bitstring in bitstrings], dtype=np.int8)
+        cut_values = GraphState(G).cut_values(colorings)
+        results = bitstrings[int(np.argmax(cut_values))]
+        progress_logger.info('best sampled outcome = %s', results)
     return results
     
 # The functions below are based on code from Lab 2
@@ -375,15 +586,40 @@ def createMergerGraph(border, subgraphs):
         and edges between vertices are added if there is an edge between
         the corresponding subgraphs
     """ 
-    M = nx.Graph()
+    # Build the vertex to subgraph lookup once instead of scanning the subgraphs for every vertex
+    owner = vertex_to_subgraph(subgraphs)
     
+    # Collect the merger edges first (keeping the order in which they are found so that
+    # the merger graph is the same on every run) and then add them to the graph all at once
+    merger_edges = {}
     for u, v in border.edges():
-        subgraph_id_for_u = subgraph_of_vertex(subgraphs, u)
-        subgraph_id_for_v = subgraph_of_vertex(subgraphs, v)
+        subgraph_id_for_u = owner.get(u, '')
+        subgraph_id_for_v = owner.get(v, '')
         if subgraph_id_for_u != subgraph_id_for_v:
-            M.add_edge(subgraph_id_for_u, subgraph_id_for_v)   
-    return M
-
+            merger_edges.setdefault(frozenset((subgraph_id_for_u, subgraph_id_for_v)), (subgraph_id_for_u, subgraph_id_for_v))
+    M = nx.Graph()
+    M.add_edges_from(merger_edges.values())
+    # merging and new_colors both read off the sorted merger graph nodes
+    return cache_node_and_edge_lists(M)
+
+
+def penalty_kernel(src, tgt, edges_u, edges_v, weights, colors, penalties):
+    """Adds the contribution of each edge (edges_u[i], edges_v[i]) between the subgraphs src[i] and tgt[i]
+    to penalties[min(src[i], tgt[i]), max(src[i], tgt[i])]"""
+    for i in range(src.shape[0]):
+        a = min(src[i], tgt[i])
+        b = max(src[i], tgt[i])
+        # Vertices outside of the subgraph partition have indices past the last subgraph and are skipped
+        if b >= penalties.shape[0]:
+            continue
+        if a != b:
+            if colors[edges_u[i]] != colors[edges_v[i]]:
+                penalties[a, b] += weights[i]
+            else:
+                penalties[a, b] -= weights[i]
+
+if njit is not None:
+    penalty_kernel = njit(cache=True)(penalty_kernel)
 
 # Compute the penalties for edges in the supplied mergerGraph
 # for the subgraph partitioning of graph G
@@ -405,17 +641,32 @@ def merger_graph_penalties(mergerGraph, subgraph_dictionary, G):
     networkX.Graph
         Merger graph containing penalties
     """ 
-    nx.set_edge_attributes(mergerGraph, int(0), 'penalty')
+    # Number the subgraphs and record which subgraph contains each vertex of G
+    subgraph_index = {key: i for i, key in enumerate(sorted(subgraph_dictionary))}
+    state = GraphState(G)
+    vertex_owner = vertex_owner_array(G, subgraph_dictionary)
+    
+    # An edge of G between two subgraphs contributes +weight to the penalty if its endpoints
+    # have different colors and -weight if they have the same color
+    src = vertex_owner[state.edges[:, 0]]
+    tgt = vertex_owner[state.edges[:, 1]]
+    
+    # Accumulate the contributions of all the crossing edges for each pair of subgraphs in one pass
+    penalties = np.zeros((len(subgraph_index), len(subgraph_index)), dtype=state.weights.dtype)
+    if njit is not None:
+        penalty_kernel(src, tgt, state.edges[:, 0], state.edges[:, 1], state.weights, state.colors, penalties)
+    else:
+        crossing = (src != tgt) & (np.maximum(src, tgt) < penalties.shape[0])
+        sign = np.where(state.colors[state.edges[:, 0]] != state.colors[state.edges[:, 1]], 1, -1)
+        np.add.at(penalties, (np.minimum(src, tgt)[crossing], np.maximum(src, tgt)[crossing]),
+                  (state.weights*sign)[crossing])
+    
+    # Record all of the penalties on the merger graph edges in one call
+    penalty_edges = []
     for i, j in mergerGraph.edges():
-        penalty_ij = 0
-        for u in nx.nodes(subgraph_dictionary[i]):
-            for neighbor_u in nx.all_neighbors(G, u):
-                if neighbor_u in nx.nodes(subgraph_dictionary[j]):
-                    if str(G.nodes[u]['color']) != str(G.nodes[neighbor_u]['color']):
-                        penalty_ij += G.edges[u,neighbor_u]['weight']
-                    else:
-                        penalty_ij += -G.edges[u,neighbor_u]['weight']
-        mergerGraph[i][j]['penalty'] = penalty_ij
+        a, b = sorted((subgraph_index[i], subgraph_index[j]))
+        penalty_edges.append((i, j, {'penalty': penalties[a, b].item()}))
+    mergerGraph.add_edges_from(penalty_edges)
     return mergerGraph
 
 
@@ -439,14 +690,9 @@ def mHamiltonian(merger_edge_src, merger_edge_tgt, penalty):
     cudaq.SpinOperator
         Hamiltonian for finding the optimal swap schedule for the subgraph partitioning encoded in the merger graph
     """  
-    mergerHamiltonian = 0
-    
- # Add Hamiltonian terms for edges within a subgraph that contain a border element
-    for i in range(len(merger_edge_src)):
-        # Add a term to the Hamiltonian for the edge (u,v)
-        qubitu = merger_edge_src[i]
-        qubitv = merger_edge_tgt[i]
-        mergerHamiltonian+= -penalty[i]*(spin.z(qubitu))*(spin.z(qubitv))
+    # Add Hamiltonian terms -penalty*Z_u Z_v for each edge (u,v) of the merger graph in a single reduction
+    mergerHamiltonian = functools.reduce(operator.add, (-float(p)*spin.z(int(u))*spin.z(int(v))
+                                                        for u, v, p in zip(merger_edge_src, merger_edge_tgt, penalty)))
     return mergerHamiltonian
 
 # A function to carry out QAOA during the merger stage of the
@@ -473,62 +719,75 @@ def merging(G, graph_dictionary, merger_graph):
         returns string of 0s and 1s indicating which subgraphs should have their colors swapped
     """  
     
+    # A merger graph with at most one vertex or without edges has nothing to merge, so don't flip any graph colors
+    if nx.number_of_edges(merger_graph) == 0 or nx.number_of_nodes(merger_graph) <= 1:
+        progress_logger.info('Merging stage is trivial')
+        return '0'*nx.number_of_nodes(merger_graph)
+    
     merger_graph_with_penalties = merger_graph_penalties(merger_graph,graph_dictionary, G)
-    # In the event that the merger penalties are not trivial, run QAOA, else don't flip any graph colors
-    if (True in (merger_graph_with_penalties[u][v]['penalty'] != 0 for u, v in nx.edges(merger_graph_with_penalties))): 
-        
-        penalty = []
-        merger_edge_src = []
-        merger_edge_tgt = []
-        merger_nodes = sorted(list(merger_graph_with_penalties.nodes()))
-        for u, v in nx.edges(merger_graph_with_penalties):
-            # We can use the index() command to read out the qubits associated with the vertex u and v.
-            merger_edge_src.append(merger_nodes.index(u))
-            merger_edge_tgt.append(merger_nodes.index(v))
-            penalty.append(merger_graph_with_penalties[u][v]['penalty'])
-            
-        merger_Hamiltonian = mHamiltonian(merger_edge_src, merger_edge_tgt, penalty)
-        
-        # Run QAOA on the merger subgraph to identify which subgraphs
-        # if any should change colors
-        layer_count_merger = 1 # Edit this line to change the layer count
-        parameter_count_merger: int = 2 * layer_count_merger
-        merger_seed = 12345 # Edit this line to change the seed for the merger call to QAOA
-        nodes_merger = sorted(list(nx.nodes(merger_graph)))
-        merger_edge_src = []
-        merger_edge_tgt = []
-        for u, v in nx.edges(merger_graph_with_penalties):
-            # We can use the index() command to read out the qubits associated with the vertex u and v.
-            merger_edge_src.append(nodes_merger.index(u))
-            merger_edge_tgt.append(nodes_merger.index(v))
-        # The number of qubits we'll need is the same as the number of vertices in our graph
-        qubit_count_merger : int = len(nodes_merger)
-
-        # Specify the initial parameters. Make it repeatable.
-        cudaq.set_random_seed(merger_seed)
-        np.random.seed(merger_seed)
-        initial_parameters_merger = np.random.uniform(-np.pi, np.pi,
-                                                      parameter_count_merger).tolist()
-        # Pass the kernel, spin operator, and optimizer to `solvers.vqe`.
-        optimal_expectation, optimal_parameters, _ = solvers.vqe(
-            lambda thetas: kernel_qaoa(qubit_count_merger, layer_count_merger, merger_edge_src, merger_edge_tgt, thetas),
-            merger_Hamiltonian,
-            initial_parameters_merger,
-            optimizer='cobyla',
-            max_iterations=150,
-            shots=20000)
-
-        # Sample the circuit using the optimized parameters
-        # Sample enough times to distinguish the most_probable outcome for
-        # merger graphs with 12 vertices
-        sample_number=20000
-        counts = cudaq.sample(kernel_qaoa, qubit_count_merger, layer_count_merger, merger_edge_src, merger_edge_tgt, optimal_parameters, shots_count=sample_number)
-        mergerResultsString = str(counts.most_probable())
+    # Read the edges and their penalties off of the merger graph in a single pass
+    merger_edges = edge_list(merger_graph_with_penalties)
+    penalty = [merger_graph_with_penalties[u][v]['penalty'] for u, v in merger_edges]
+    
+    # The merger Hamiltonian is minimized by giving s_u s_v the sign of the penalty on every edge (u,v).
+    # If no penalty is negative, flipping none of the subgraphs does this. If no penalty is positive and
+    # the edges with nonzero penalties form a bipartite graph, a 2-coloring of that graph does this.
+    # In both cases we can skip QAOA.
+    nonzero_edges = [(u, v) for (u, v), p in zip(merger_edges, penalty) if p != 0]
+    nodes_merger = sorted_nodes(merger_graph_with_penalties)
+    if all(p >= 0 for p in penalty):
+        mergerResultsString = '0'*len(nodes_merger)
+        progress_logger.info('Merging stage is trivial')
+        return mergerResultsString
+    if all(p <= 0 for p in penalty):
+        nonzero_penalty_graph = nx.Graph(nonzero_edges)
+        if nx.is_bipartite(nonzero_penalty_graph):
+            flips = nx.bipartite.color(nonzero_penalty_graph)
+            mergerResultsString = ''.join(str(flips.get(u, 0)) for u in nodes_merger)
+            progress_logger.info('Merging stage is solved by a 2-coloring of the merger graph')
+            return mergerResultsString
+    
+    # Otherwise the merger penalties are not trivial, so run QAOA on the merger graph
+    idx_merger = {node: i for i, node in enumerate(nodes_merger)}
+    # We can use the idx_merger dictionary to read out the qubits associated with the vertex u and v.
+    merger_edge_src = [idx_merger[u] for u, _ in merger_edges]
+    merger_edge_tgt = [idx_merger[v] for _, v in merger_edges]
         
-    else:
-        mergerResultsList = [0]*nx.number_of_nodes(merger_graph)
-        mergerResultsString = ''.join(str(x) for x in mergerResultsList)
-        print('Merging stage is trivial')
+    merger_Hamiltonian = mHamiltonian(merger_edge_src, merger_edge_tgt, penalty)
+    
+    # Run QAOA on the merger subgraph to identify which subgraphs
+    # if any should change colors
+    layer_count_merger = 1 # Edit this line to change the layer count
+    parameter_count_merger: int = 2 * layer_count_merger
+    merger_seed = 12345 # Edit this line to change the seed for the merger call to QAOA
+    # The number of qubits we'll need is the same as the number of vertices in our graph
+    qubit_count_merger : int = len(nodes_merger)
+
+    # Specify the initial parameters and seed the sampler. Make it repeatable.
+    cudaq.set_random_seed(merger_seed)
+    rng = np.random.default_rng(merger_seed)
+    initial_parameters_merger = rng.uniform(-np.pi, np.pi, parameter_count_merger).tolist()
+    # Pass the kernel, spin operator, optimizer, and gradient to `solvers.vqe`.
+    # We compute exact expectation values (no shots) so that the parameter-shift
+    # gradients used by L-BFGS are not polluted by sampling noise.
+    optimal_expectation, optimal_parameters, _ = solvers.vqe(
+        lambda thetas: kernel_qaoa(qubit_count_merger, layer_count_merger, merger_edge_src, merger_edge_tgt, thetas),
+        merger_Hamiltonian,
+        initial_parameters_merger,
+        optimizer='lbfgs',
+        gradient='parameter_shift',
+        max_iterations=150)
+
+    # Sample the circuit using the optimized parameters
+    # A low depth circuit on a merger graph with about 12 vertices concentrates
+    # on few enough outcomes that 2000 shots distinguishes the most probable one
+    sample_number=2000
+    counts = cudaq.sample(kernel_qaoa, qubit_count_merger, layer_count_merger, merger_edge_src, merger_edge_tgt, optimal_parameters, shots_count=sample_number)
+    # Read the counts into arrays once so that they can be reused, and pick out the most probable outcome
+    items = list(counts.items())
+    bitstrings = [bitstring for bitstring, _ in items]
+    frequencies = np.fromiter((count for _, count in items), dtype=np.int64, count=len(items))
+    mergerResultsString = str(bitstrings[int(frequencies.argmax())])
     return mergerResultsString
 
 
@@ -557,17 +816,17 @@ def unaltered_colors(G, graph_dictionary, max_cuts):
     networkX.Graph, str
         returns G with colored nodes
     """  
-    subgraphColors={}
-
+    state = GraphState(G)
     
     for key in graph_dictionary:
         SubG = graph_dictionary[key]
-        sorted_subgraph_nodes = sorted(list(nx.nodes(SubG)))
-        for v in sorted_subgraph_nodes:
-            G.nodes[v]['color']=max_cuts[key][sorted_subgraph_nodes.index(v)]
+        sorted_subgraph_nodes = sorted_nodes(SubG)
+        # Copy the subgraph colors into the color array in one slice assignment
+        subgraph_indices = [state.node_index[v] for v in sorted_subgraph_nodes]
+        state.colors[subgraph_indices] = np.fromiter(map(int, max_cuts[key]), dtype=np.int8)
     # returns the input graph G with a coloring of the nodes based on the unaltered merger
     # of the max cut solutions of the subgraphs in the graph_dictionary
-    return G
+    return state.write_colors(G)
 
 def new_colors(graph_dictionary, G, mergerGraph, flip_colors):
     """For each subgraph in the flip_colors list, changes the color of all the vertices in that subgraph
@@ -592,21 +851,23 @@ def new_colors(graph_dictionary, G, mergerGraph, flip_colors):
         returns G with the revised vertex colors
     """  
     flipGraphColors={}
-    mergerNodes = sorted(list(nx.nodes(mergerGraph)))
-    for u in mergerNodes:
-        indexu = mergerNodes.index(u)
+    mergerNodes = sorted_nodes(mergerGraph)
+    for indexu, u in enumerate(mergerNodes):
         flipGraphColors[u]=int(flip_colors[indexu])
    
+    # Build a mask that is 1 on the vertices of the subgraphs whose colors are flipped
+    # and flip those colors with a single XOR
+    state = GraphState(G)
+    flip_mask = np.zeros(len(state.nodes), dtype=np.int8)
     for key in graph_dictionary:
-        if flipGraphColors[key]==1:
-            for u in graph_dictionary[key].nodes():
-                G.nodes[u]['color'] = str(1 - int(G.nodes[u]['color']))
+        # Subgraphs that are not in the merger graph have no edges to other subgraphs and are never flipped
+        if flipGraphColors.get(key, 0)==1:
+            flip_mask[[state.node_index[u] for u in graph_dictionary[key].nodes()]] = 1
+    state.colors ^= flip_mask
     
-    revised_colors = ''
-    for u in sorted(G.nodes()):
-        revised_colors += str(G.nodes[u]['color'])
+    revised_colors = ''.join(map(str, state.colors.tolist()))
     
-    return G, revised_colors
+    return state.write_colors(G), revised_colors
 
 
 def subgraph_solution(G, key, vertex_limit, subgraph_limit, layer_count, global_graph,seed ):
@@ -637,14 +898,14 @@ def subgraph_solution(G, key, vertex_limit, subgraph_limit, layer_count, global_
     results ={}
     # Find the max cut of G using QAOA, provided G is small enough
     if nx.number_of_nodes(G)<vertex_limit+1:
-        print('Working on finding max cut approximations for ',key)
+        progress_logger.info('Working on finding max cut approximations for %s', key)
         
         result =qaoa_for_graph(G, seed=seed, shots = 10000, layer_count=layer_count)
         results[key]=result
         # color the global graph's nodes according to the results
-        nodes_of_G = sorted(list(G.nodes()))
-        for u in G.nodes():
-            global_graph.nodes[u]['color']=results[key][nodes_of_G.index(u)]
+        nodes_of_G = sorted_nodes(G)
+        for i, u in enumerate(nodes_of_G):
+            global_graph.nodes[u]['color']=results[key][i]
         return result
     else: # Recursively apply the algorithm in case G is too big
         # Divide the graph and identify the subgraph dictionary
@@ -652,20 +913,24 @@ def subgraph_solution(G, key, vertex_limit, subgraph_limit, layer_count, global_
         subgraph_dictionary = subgraphpartition(G,subgraph_limit, str(key), global_graph)
         
         # Conquer: solve the subgraph problems recursively
+        # Each GPU process only reaches this point with the top-level subgraphs in its own
+        # assigned_subgraph_dictionary, so the recursion is already spread across the QPUs.
+        # We keep the recursion local to this process: the processes are working on different
+        # subgraphs, so any MPI communication from inside the recursion would leave them waiting on each other.
         for skey in subgraph_dictionary:
             results[skey]=subgraph_solution(subgraph_dictionary[skey], skey, vertex_limit, subgraph_limit, \
                                             layer_count, global_graph, seed )
             
-        print('Found max cut approximations for ',list(subgraph_dictionary.keys()))
+        progress_logger.info('Found max cut approximations for %s', list(subgraph_dictionary.keys()))
         
        
         # Color the nodes of G to indicate subgraph max cut solutions
         G = unaltered_colors(G, subgraph_dictionary, results)
         unaltered_cut_value = cutvalue(G)
-        print('prior to merging, the max cut value of',key,'is', unaltered_cut_value)
+        progress_logger.info('prior to merging, the max cut value of %s is %s', key, unaltered_cut_value)
         
         # Merge: merge the results from the conquer stage
-        print('Merging these solutions together for a solution to',key)
+        progress_logger.info('Merging these solutions together for a solution to %s', key)
         # Define the border graph
         bordergraph = border(G, subgraph_dictionary)
         # Define the merger graph
@@ -678,126 +943,129 @@ def subgraph_solution(G, key, vertex_limit, subgraph_limit, layer_count, global_
             # In case QAOA for merger graph does not converge, don't flip any of the colors for the merger
             mergerResultsList = [0]*nx.number_of_nodes(merger_graph)
             merger_results = ''.join(str(x) for x in mergerResultsList)
-            print('Merging subroutine opted out with an error for', key)
+            progress_logger.warning('Merging subroutine opted out with an error for %s', key)
         
         # Color the nodes of G to indicate the merged subgraph solutions
         alteredG, new_color_list = new_colors(subgraph_dictionary, G, merger_graph, merger_results)
         newcut = cutvalue(alteredG)
-        print('the merger algorithm produced a new coloring of',key,'with cut value,',newcut)
+        progress_logger.info('the merger algorithm produced a new coloring of %s with cut value, %s', key, newcut)
 
         
         
         return new_color_list
+
+
+def one_exchange_cut_value(G, seed):
+    """
+    Classical one-exchange max cut approximation of G, used as a baseline for the QAOA results
+    Parameters
+    ----------
+    G : networkX.Graph 
+        Graph
+    seed : int
+        random seed for the one-exchange algorithm
+
+    Returns
+    -------
+    float
+        cut value of the one-exchange approximation
+    """
+    return nx.algorithms.approximation.one_exchange(G, initial_cut=None, seed=int(seed))[0]
 ##################################################################################
 # end of definitions
 # beginning of algorithm
 ##################################################################################
-if rank ==0:
-    # Load graph
-    # Use the graph from Lab 3 to test out the algorithm
-    
-    # Newman Watts Strogatz network model
-    #n = 100 # number of nodes
-    #k = 4 # each node joined to k nearest neighbors
-    #p =0.8 # probability of adding a new edge
-    #seed = 1234
-    #sampleGraph3=nx.newman_watts_strogatz_graph(n, k, p, seed=seed)
-
-
-    # Random d-regular graphs used in the paper arxiv:2205.11762
-    # d from 3, 9 inclusive
-    # number of vertices from from 60 to 80
-    # taking d=6 and n =100, works well
-    d = 6
-    n =70
-    graph_seed = 1234
-    sampleGraph3=nx.random_regular_graph(d,n,seed=graph_seed)
-
-    #random graph from lab 2 
-    #n = 30  # number of nodes
-    #m = 70  # number of edges
-    #seed= 20160  # seed random number generators for reproducibility
-    # Use seed for reproducibility
-    #sampleGraph3= nx.gnm_random_graph(n, m, seed=seed)
-    
-    # set edge weights equal to 1
-    # all weights = 1 is equivalent to solving the unweighted max cut problem
-    nx.set_edge_attributes(sampleGraph3, values = 1, name = 'weight')
-    
-    # set edge weights of -1 and 1 from a non uniform distribution
-    #np.random.seed(seed)
-    #for e in sampleGraph3.edges():
-    #    random_assignment = np.random.randint(0, 1)
-    #    sampleGraph3.edges[e]['weight'] = -1**random_assignment
-    
-    # set edge weights of 0 and 5 from a non uniform distribution
-    #np.random.seed(seed)
-    #for e in sampleGraph3.edges():
-    #    random_assignment = np.random.randint(0, 5)
-    #    sampleGraph3.edges[e]['weight'] = random_assignment
-    
-    
-    # subdivide once
-    def Lab2SubgraphPartition(G,n):
-        """Divide the graph up into at most n subgraphs
-    
-        Parameters
-        ----------
-        G: networkX.Graph 
-            Graph that we want to subdivide
-        n : int
-            n is the maximum number of subgraphs in the partition
-
-        Returns
-        -------
-        dict of str : networkX.Graph
-            Dictionary of networkX graphs with a string as the key
-        """
-        # n is the maximum number of subgraphs in the partition
-        greedy_partition = community.greedy_modularity_communities(G, weight=None, resolution=1.1, cutoff=1, best_n=n)
-        number_of_subgraphs = len(greedy_partition)
-
-        graph_dictionary = {}
-        graph_names=[]
-        for i in range(number_of_subgraphs):
-            name='Global:'+str(i)
-            graph_names.append(name)
-
-        for i in range(number_of_subgraphs):
-            nodelist = sorted(list(greedy_partition[i]))
-            graph_dictionary[graph_names[i]] = nx.subgraph(G, nodelist)
-     
-        return(graph_dictionary) 
-
-    subgraph_dictionary = Lab2SubgraphPartition(sampleGraph3,12)
-    
-    # Assign the subgraphs to the QPUs
-    number_of_subgraphs = len(sorted(subgraph_dictionary))
-    number_of_subgraphs_per_qpu = int(np.ceil(number_of_subgraphs/num_qpus))
-
-    keys_on_qpu ={}
-    
-    for q in range(num_qpus):
-        keys_on_qpu[q]=[]
-        for k in range(number_of_subgraphs_per_qpu):
-            if (k*num_qpus+q < number_of_subgraphs):
-                key = sorted(subgraph_dictionary)[k*num_qpus+q]
-                keys_on_qpu[q].append(key)        
-    print('Subgraph problems to be computed on each processor have been assigned')
-    # Allocate subgraph problems to the GPUs
-    # Distribute the subgraph data to the QPUs
-    for i in range(num_qpus):
-        subgraph_to_qpu ={}
-        for k in keys_on_qpu[i]:
-            subgraph_to_qpu[k]= subgraph_dictionary[k]
-        if i != 0:
-            comm.send(subgraph_to_qpu, dest=i, tag=rank)
-        else:
-            assigned_subgraph_dictionary = subgraph_to_qpu
-else:
-# Receive the subgraph data
-    assigned_subgraph_dictionary= comm.recv(source=0, tag=0)
-    print("Processor {} received {} from processor {}".format(rank,assigned_subgraph_dictionary, 0))
+# Every GPU process builds the same graph from the fixed graph_seed and computes the
+# same (deterministic) partition, so no process has to wait for process 0 to send it the subgraphs
+
+# Load graph
+# Use the graph from Lab 3 to test out the algorithm
+
+# Newman Watts Strogatz network model
+#n = 100 # number of nodes
+#k = 4 # each node joined to k nearest neighbors
+#p =0.8 # probability of adding a new edge
+#seed = 1234
+#sampleGraph3=nx.newman_watts_strogatz_graph(n, k, p, seed=seed)
+
+
+# Random d-regular graphs used in the paper arxiv:2205.11762
+# d from 3, 9 inclusive
+# number of vertices from from 60 to 80
+# taking d=6 and n =100, works well
+d = 6
+n =70
+graph_seed = 1234
+sampleGraph3=nx.random_regular_graph(d,n,seed=graph_seed)
+
+#random graph from lab 2 
+#n = 30  # number of nodes
+#m = 70  # number of edges
+#seed= 20160  # seed random number generators for reproducibility
+# Use seed for reproducibility
+#sampleGraph3= nx.gnm_random_graph(n, m, seed=seed)
+
+# set edge weights equal to 1
+# all weights = 1 is equivalent to solving the unweighted max cut problem
+nx.set_edge_attributes(sampleGraph3, values = 1, name = 'weight')
+
+# set edge weights of -1 and 1 from a non uniform distribution
+#np.random.seed(seed)
+#for e in sampleGraph3.edges():
+#    random_assignment = np.random.randint(0, 1)
+#    sampleGraph3.edges[e]['weight'] = -1**random_assignment
+
+# set edge weights of 0 and 5 from a non uniform distribution
+#np.random.seed(seed)
+#for e in sampleGraph3.edges():
+#    random_assignment = np.random.randint(0, 5)
+#    sampleGraph3.edges[e]['weight'] = random_assignment
+
+# The structure and weights of sampleGraph3 are now fixed
+cache_node_and_edge_lists(sampleGraph3)
+
+# subdivide once
+def Lab2SubgraphPartition(G,n):
+    """Divide the graph up into at most n subgraphs
+
+    Parameters
+    ----------
+    G: networkX.Graph 
+        Graph that we want to subdivide
+    n : int
+        n is the maximum number of subgraphs in the partition
+
+    Returns
+    -------
+    dict of str : networkX.Graph
+        Dictionary of networkX graphs with a string as the key
+    """
+    # n is the maximum number of subgraphs in the partition
+    greedy_partition = community.greedy_modularity_communities(G, weight=None, resolution=1.1, cutoff=1, best_n=n)
+    number_of_subgraphs = len(greedy_partition)
+
+    graph_dictionary = {}
+    graph_names=[]
+    for i in range(number_of_subgraphs):
+        name='Global:'+str(i)
+        graph_names.append(name)
+
+    for i in range(number_of_subgraphs):
+        nodelist = sorted(greedy_partition[i])
+        graph_dictionary[graph_names[i]] = cache_node_and_edge_lists(G.subgraph(nodelist).copy())
+ 
+    return(graph_dictionary) 
+
+subgraph_dictionary = Lab2SubgraphPartition(sampleGraph3,12)
+
+# Assign the subgraphs to the QPUs round-robin over the sorted keys:
+# each GPU process picks out the subgraph problems assigned to it from its own copy of subgraph_dictionary
+sorted_keys = sorted(subgraph_dictionary)
+keys_on_qpu = [sorted_keys[q::num_qpus] for q in range(num_qpus)]
+my_keys = keys_on_qpu[rank]
+assigned_subgraph_dictionary = {k: subgraph_dictionary[k] for k in my_keys}
+logger.info('Subgraph problems to be computed on each processor have been assigned')
+logger.debug('Processor %d was assigned %d subgraphs: %s', rank, len(my_keys), my_keys)
 
 
 #########################################################################
@@ -808,29 +1076,42 @@ num_subgraphs=11 # limits the size of the merger graphs
 num_qubits = 14 # max number of qubits allowed in a quantum circuit
 layer_count =1 # Layer count for the QAOA max cut
 seed = 13 # Seed for QAOA for max cut
+
+# The solution of each subgraph is copied over to GPU 0 as an int8 array of colors, tagged with
+# the position of its key in sorted_keys. Every GPU process knows the size of every subgraph, so
+# GPU 0 can post all of its receives before it starts on its own subgraphs, and the other GPUs
+# send each solution as soon as it is found. The transfers then overlap with the remaining QAOA runs.
+key_tag = {key: i for i, key in enumerate(sorted_keys)}
+received_colors = {}
+requests = []
+if rank == 0:
+    for q in range(1, num_qpus):
+        for key in keys_on_qpu[q]:
+            received_colors[key] = np.empty(nx.number_of_nodes(subgraph_dictionary[key]), dtype=np.int8)
+            requests.append(comm.Irecv(received_colors[key], source=q, tag=key_tag[key]))
+
 results = {}
 for key in assigned_subgraph_dictionary:
     G = assigned_subgraph_dictionary[key]
     newcoloring_of_G = subgraph_solution(G, key, num_subgraphs, num_qubits, layer_count, G, seed = seed)
-    results[key]=newcoloring_of_G
+    # Convert the string of 0s and 1s to an int8 array without a Python-level loop
+    results[key]=(np.frombuffer(newcoloring_of_G.encode(), dtype=np.uint8) - ord('0')).astype(np.int8)
+    if rank != 0:
+        requests.append(comm.Isend(results[key], dest=0, tag=key_tag[key]))
 
 
 ############################################################################
 # Copy over the subgraph solutions from the individual GPUs
 # back to GPU 0.
  #############################################################################
-# Copy the results over to QPU 0 for consolidation 
-if rank!=0:
-    comm.send(results, dest=0, tag = 0)
-    print("{} sent by processor {}".format(results, rank))
-    
-else:
-    for j in range(1,num_qpus,1):
-        colors  = comm.recv(source = j, tag =0)
-        print("Received {} from processor {}".format(colors, j))
-        for key in colors:
-            results[key]=colors[key]
-    print("The results dictionary on GPU 0 =", results)
+# Wait for the solutions still in flight
+MPI.Request.Waitall(requests)
+
+if rank == 0:
+    results.update(received_colors)
+    results = {key: results[key] for key in sorted_keys}
+    logger.info('Received the max cut approximations of %d subgraphs on GPU 0', len(results))
+    logger.debug('The results dictionary on GPU 0 = %s', results)
  
     
     #######################################################
@@ -845,18 +1126,22 @@ else:
     subgraphColors={}
 
     for key in subgraph_dictionary:
-        subgraphColors[key]=[int(i) for i in results[key]]
+        subgraphColors[key]=results[key]
 
+    # Copy the colors of each subgraph into one color array for the vertices of sampleGraph3
+    # with a slice assignment, and then attach all of the colors to the NetworkX graphs at once
+    global_state = GraphState(sampleGraph3)
     for key in subgraph_dictionary:
         G = subgraph_dictionary[key]
-        for v in sorted(list(nx.nodes(G))):
-            G.nodes[v]['color']=subgraphColors[key][sorted(list(nx.nodes(G))).index(v)]
-            sampleGraph3.nodes[v]['color']=G.nodes[v]['color']
+        nodes_sorted = sorted_nodes(G)
+        global_state.colors[[global_state.node_index[v] for v in nodes_sorted]] = subgraphColors[key]
+        nx.set_node_attributes(G, dict(zip(nodes_sorted, subgraphColors[key].tolist())), 'color')
+    nx.set_node_attributes(sampleGraph3, dict(zip(global_state.nodes, global_state.colors.tolist())), 'color')
     
     
 
     
-    print('The divide-and-conquer QAOA unaltered cut approximation of the graph, prior to the final merge, is ',cutvalue(sampleGraph3))
+    logger.info('The divide-and-conquer QAOA unaltered cut approximation of the graph, prior to the final merge, is %s', global_state.cut_value())
     
     # Merge
     borderGraph = border(sampleGraph3, subgraph_dictionary)
@@ -867,24 +1152,31 @@ else:
    
 
     
-    print('The divide-and-conquer QAOA max cut approximation of the graph is ',cutvalue(maxcutSampleGraph3))
-    
-    ###### can parallelize this
-    number_of_approx =10
-    randomlist = np.random.choice(3000,number_of_approx)
-    minapprox = nx.algorithms.approximation.one_exchange(sampleGraph3, initial_cut=None, seed=int(randomlist[0]))[0]
-    maxapprox = minapprox
-    sum_of_approximations = 0
-    for i in range(number_of_approx):
-        seed = int(randomlist[i])
-        ith_approximation = nx.algorithms.approximation.one_exchange(sampleGraph3, initial_cut=None, seed=seed)[0]
-        if ith_approximation < minapprox:
-            minapprox = ith_approximation
-        if ith_approximation > maxapprox:
-            maxapprox = ith_approximation
-        sum_of_approximations +=ith_approximation
+    logger.info('The divide-and-conquer QAOA max cut approximation of the graph is %s', cutvalue(maxcutSampleGraph3))
 
-    average_approx = sum_of_approximations/number_of_approx
 
-    print('This compares to a few runs of the greedy modularity maximization algorithm gives an average approximate Max Cut value of',average_approx)
-    print('with approximations ranging from',minapprox,'to',maxapprox)
+############################################################################
+# Classical baseline, shared out over all of the GPU processes
+############################################################################
+# The approximations are independent of each other, so every process runs its share of them
+# while GPU 0 works on the final merge. Each process only has a few of them to run, so starting
+# a pool of worker processes per GPU process would cost more than it saves.
+# Every process draws the same seeds from the same rng, so only the cut values are sent to GPU 0.
+number_of_approx =10
+# Draw distinct seeds so that no two runs repeat the same approximation
+rng = np.random.default_rng(seed)
+randomlist = rng.choice(3000, number_of_approx, replace=False)
+local_seeds = randomlist[rank::num_qpus]
+local_approximations = [one_exchange_cut_value(sampleGraph3, s) for s in local_seeds]
+gathered_approximations = comm.gather(local_approximations, root=0)
+
+if rank == 0:
+    # Keep the cut values as the Python numbers one_exchange returns (ints for unweighted graphs)
+    approximations = [a for part in gathered_approximations for a in part]
+
+    minapprox = min(approximations)
+    maxapprox = max(approximations)
+    average_approx = sum(approximations)/len(approximations)
+
+    logger.info('This compares to a few runs of the greedy modularity maximization algorithm gives an average approximate Max Cut value of %s', average_approx)
+    logger.info('with approximations ranging from %s to %s', minapprox, maxapprox)